@@ -1,11 +1,15 @@
 import asyncio
+import functools
 import logging
 import re
 from asyncio import Queue
-from typing import List, Union
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
 
 from .connection_wrapper import receive, send
-from .protocol import CMD_PORT, CMD_PUB, CMD_SUB, CMD_UNSUB, ENDIANNESS, OK, UTF8, command, ok, parse_cmd_response
+from .protocol import (CMD_KEYED_PUB, CMD_PORT, CMD_PUB, CMD_SUB, CMD_TRACE, CMD_UNSUB, ENDIANNESS, OK, UTF8,
+                       command, ok, pack_keyed, parse_cmd_response)
+from .tracing import DEQUEUE, ENQUEUE, span
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
@@ -26,6 +30,7 @@ def _port_to_bytes(port: int):
 
 
 ALLOWED_TOPIC_RE = re.compile(r"[\w_\-\d]+")
+MAX_INTERVAL_MS = 1 << 32
 
 
 # noinspection PyBroadException
@@ -34,10 +39,13 @@ class Client:
 
     _receiving: asyncio.Event
     port: int = None
+    session: Optional[str]
 
-    def __init__(self, server_port: int):
+    def __init__(self, server_port: int, session: str = None, server_host: str = None):
         self.__data_queue = None
         self.server_port = server_port
+        self.server_host = server_host or LOCALHOST
+        self.session = session
         self._receiving = asyncio.Event()
 
     @property
@@ -47,9 +55,14 @@ class Client:
                              "Call client.start_consuming() first")
         return self.__data_queue
 
-    async def start_consuming(self):
-        """Start TCP server receiving data from service"""
-        self.__data_queue = Queue()
+    async def start_consuming(self, queue_size: int = 0):
+        """Start TCP server receiving data from service
+
+        If ``queue_size > 0``, input queue is bounded: when it is full, new messages are not
+        acknowledged until there is free space, so the service waits for slow consumer.
+        If there is no free space in ``server.ACK_TIMEOUT`` seconds, the message is dropped
+        """
+        self.__data_queue = Queue(queue_size)
         self.port = await self.get_port()
         await asyncio.start_server(self._consume_input, LOCALHOST, self.port)
         await asyncio.sleep(.05)
@@ -58,15 +71,30 @@ class Client:
     async def _consume_input(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """Process input connections"""
         message = await receive(reader)
-        await self._data_queue.put(message)
-        await send(writer, ok(b"", b""))
+        with span(ENQUEUE, self.port):
+            enqueued = await self._enqueue(message, reader)
+        if enqueued:
+            await send(writer, ok(b"", b""))
+        else:
+            LOGGER.warning("Input queue of client %s is full, message dropped", self.port)
         writer.close()
         await writer.wait_closed()
 
+    async def _enqueue(self, message: bytes, reader: asyncio.StreamReader) -> bool:
+        """Put message to input queue unless service closes connection while waiting for free space"""
+        put = asyncio.ensure_future(self._data_queue.put(message))
+        closed = asyncio.ensure_future(reader.read())
+        await asyncio.wait([put, closed], return_when=asyncio.FIRST_COMPLETED)
+        closed.cancel()
+        if put.done():
+            return True
+        put.cancel()
+        return False
+
     async def send_command(self, cmd, topic, data: Union[bytes, str] = ""):
         """Send command to service"""
         message = command(cmd, topic, data)
-        reader, writer = await asyncio.open_connection(LOCALHOST, self.server_port)
+        reader, writer = await asyncio.open_connection(self.server_host, self.server_port)
         try:
             await send(writer, message)
             resolution, response = parse_cmd_response(await receive(reader))
@@ -80,23 +108,48 @@ class Client:
             await writer.wait_closed()
 
     async def get_port(self):
-        """Get port for the client"""
+        """Get port for the client
+
+        If client has ``session``, port and subscriptions of that session are resumed
+        """
         if self.port is None:
-            response = await self.send_command(CMD_PORT, "-")
+            response = await self.send_command(CMD_PORT, "-", self.session or "")
             self.port = int(response.topic.decode(UTF8))
+            self.session = response.data.decode(UTF8)
         return self.port
 
-    async def publish(self, topic: str, data: str):
-        """Publish data to service"""
-        await self.get_port()
-        await self.send_command(CMD_PUB, topic, data)
+    async def publish(self, topic: str, data: str, key: str = None):
+        """Publish data to service
 
-    async def subscribe(self, topic: str):
-        """Subscribe client to a topic"""
+        ``key`` is used by conflated subscriptions: only the latest message per topic and key is delivered
+        """
+        await self.get_port()
+        if key is None:
+            await self.send_command(CMD_PUB, topic, data)
+        else:
+            await self.send_command(CMD_KEYED_PUB, topic, pack_keyed(key, data))
+
+    async def subscribe(self, topic: str, conflate: bool = False, interval: float = 0.0):
+        """Subscribe client to a topic
+
+        If ``conflate`` is set, service keeps only the latest undelivered message per topic and key
+        for the client, so slow client receives latest values instead of growing backlog.
+        Use it together with bounded input queue (see ``start_consuming``).
+        Conflated messages with the same key are delivered not more often than once per ``interval`` seconds,
+        ``interval`` can't be used without ``conflate``
+        """
+        if interval and not conflate:
+            raise ValueError("Interval is supported only for conflated subscription")
         await self.get_port()
         if ALLOWED_TOPIC_RE.fullmatch(topic) is None:
             raise TypeError("Topic can be only ASCII letters")
-        await self.send_command(CMD_SUB, topic, _port_to_bytes(self.port))
+        data = _port_to_bytes(self.port)
+        if conflate:
+            interval_ms = round(interval * 1000)
+            if not 0 <= interval_ms < MAX_INTERVAL_MS:
+                raise ValueError(f"Interval should be in [0, {MAX_INTERVAL_MS / 1000}) seconds, got {interval}")
+            data += interval_ms.to_bytes(4, ENDIANNESS)
+        await self.send_command(CMD_SUB, topic, data)
 
     async def unsubscribe(self, topic: str):
         """Unsubscribe client from topic
@@ -105,6 +158,15 @@ class Client:
         """
         await self.send_command(CMD_UNSUB, topic, _port_to_bytes(self.port))
 
+    async def trace(self, mode: str) -> str:
+        """Control tracing inside service process
+
+        Modes are ``ring`` (in-memory span buffer), ``profile`` (cProfile), ``off`` and ``dump``,
+        the last one returns report of currently installed sink
+        """
+        response = await self.send_command(CMD_TRACE, mode)
+        return response.data.decode(UTF8)
+
     async def get(self, timeout=0.0):
         """Get single data message from input queue
 
@@ -112,11 +174,12 @@ class Client:
         If ``timeout > 0``, will wait for given seconds if input queue is empty.
         If ``timeout is None``, will wait forever
         """
-        try:
-            data: bytes = await asyncio.wait_for(self._data_queue.get(), timeout)
-        except asyncio.TimeoutError:
-            return None
-        return data.decode(UTF8)
+        with span(DEQUEUE, self.port):
+            try:
+                data: bytes = await asyncio.wait_for(self._data_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            return data.decode(UTF8)
 
     def get_all(self) -> List[str]:
         """Get all already received messages"""
@@ -131,16 +194,73 @@ class Client:
 
         self._receiving.set()
         while self._receiving.is_set():
-            try:
-                data: bytes = await asyncio.wait_for(self._data_queue.get(), .1)
-            except asyncio.TimeoutError:
-                continue
-            self._data_queue.task_done()
-            yield data.decode(UTF8)
+            with span(DEQUEUE, self.port):
+                try:
+                    data: bytes = await asyncio.wait_for(self._data_queue.get(), .1)
+                except asyncio.TimeoutError:
+                    continue
+                self._data_queue.task_done()
+                message = data.decode(UTF8)
+            yield message
         remaining = self._data_queue.qsize()
         if remaining > 0:
             LOGGER.info("Remaining tasks in queue: %s", remaining)  # pragma: no cover
 
+    async def consume(self, handler: Callable[[str], Any], concurrency: int = 1,
+                      executor: Optional[Executor] = None,
+                      key: Optional[Callable[[str], Hashable]] = None):
+        """Dispatch received messages to ``handler`` until ``stop_getting`` is called
+
+        Coroutine function handlers are run as tasks in current loop, so they can't be combined
+        with ``executor``. Any other callable is run in ``executor`` (default loop executor
+        if not given), e.g. in thread or process pool.
+        Not more than ``concurrency`` messages are processed at the same time, no new messages
+        are taken from input queue until there is free slot.
+        If ``key`` is given, messages with the same ``key(message)`` are handled in receiving order
+        """
+        if concurrency < 1:
+            raise ValueError(f"Concurrency should be positive, got {concurrency}")
+        if executor is not None and asyncio.iscoroutinefunction(handler):
+            raise ValueError("Coroutine function handler can't be run in executor")
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(concurrency)
+        in_flight = set()
+        last_by_key: Dict[Hashable, asyncio.Future] = {}
+
+        async def _handle(data: str, previous: Optional[asyncio.Future]):
+            try:
+                if previous is not None:
+                    await asyncio.wait([previous])
+                if asyncio.iscoroutinefunction(handler):
+                    await handler(data)
+                else:
+                    await loop.run_in_executor(executor, functools.partial(handler, data))
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Handler failed to process message")
+            finally:
+                slots.release()
+
+        def _forget(task: asyncio.Future, msg_key: Hashable):
+            in_flight.discard(task)
+            if last_by_key.get(msg_key) is task:
+                del last_by_key[msg_key]
+
+        self._receiving.set()
+        while self._receiving.is_set():
+            await slots.acquire()
+            data = await self.get(.1)
+            if data is None:
+                slots.release()
+                continue
+            msg_key = None if key is None else key(data)
+            task = asyncio.ensure_future(_handle(data, last_by_key.get(msg_key)))
+            if key is not None:
+                last_by_key[msg_key] = task
+            in_flight.add(task)
+            task.add_done_callback(functools.partial(_forget, msg_key=msg_key))
+        if in_flight:
+            await asyncio.wait(in_flight)
+
     def stop_getting(self):
         """Stop async generator"""
         self._receiving.clear()
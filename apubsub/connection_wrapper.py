@@ -5,6 +5,7 @@ import logging
 from zlib import adler32
 
 from apubsub.protocol import ENDIANNESS, MESSAGE_START, build_packet
+from apubsub.tracing import ENCODE, RECEIVE, SEND, span
 
 
 class NotMessage(Exception):
@@ -35,15 +36,18 @@ async def receive(reader: asyncio.StreamReader) -> bytes:
     if first[:1] != MESSAGE_START:
         raise NotMessage(f"No start bytes found. All data in reader: {await reader.read(1024)}")
 
-    size = int.from_bytes(await reader.readexactly(3), ENDIANNESS)
-    body = await reader.readexactly(size)
-    data = body[:-4]
-    validate_checksum(data, body[-4:])
+    with span(RECEIVE):
+        size = int.from_bytes(await reader.readexactly(3), ENDIANNESS)
+        body = await reader.readexactly(size)
+        data = body[:-4]
+        validate_checksum(data, body[-4:])
     return bytes(data)
 
 
 async def send(writer: asyncio.StreamWriter, data: bytes):
     """Send message to socket"""
-    message = build_packet(data)
-    writer.write(message)
-    await writer.drain()
+    with span(ENCODE):
+        message = build_packet(data)
+    with span(SEND):
+        writer.write(message)
+        await writer.drain()
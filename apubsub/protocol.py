@@ -38,8 +38,24 @@ def _convert_to_bytes(*args: Iterable[AnyStr]) -> List[bytes]:
 CMD_PORT = b"PORT"
 CMD_RM_PORT = b"RMPORT"
 CMD_PUB = b"PUB"
+CMD_KEYED_PUB = b"KPUB"
 CMD_SUB = b"SUB"
 CMD_UNSUB = b"USUB"
+CMD_TRACE = b"TRACE"
+
+# Requests between peer services
+
+CMD_PEER = b"PEER"
+CMD_PEER_SUB = b"PSUB"
+CMD_PEER_UNSUB = b"PUSUB"
+CMD_FORWARD = b"FWD"
+
+# Tracing modes for CMD_TRACE
+
+TRACE_RING = "ring"
+TRACE_PROFILE = "profile"
+TRACE_OFF = "off"
+TRACE_DUMP = "dump"
 
 
 class MaxSizeOverflow(Exception):
@@ -84,6 +100,52 @@ def parse_command(message: bytes) -> ParsedMessage:
     return ParsedMessage(cmd, topic, *data)
 
 
+def pack_keyed(key: AnyStr, data: AnyStr) -> bytes:
+    """Prepend conflation key to published data"""
+    key, data = _convert_to_bytes(key, data)  # pylint: disable=unbalanced-tuple-unpacking
+    return len(key).to_bytes(2, ENDIANNESS) + key + data
+
+
+def unpack_keyed(data: bytes) -> Tuple[bytes, bytes]:
+    """Split data packed with ``pack_keyed`` into key and data"""
+    size = int.from_bytes(data[:2], ENDIANNESS)
+    if len(data) < 2 + size:
+        raise ParsingError("Key is truncated")
+    return data[2:2 + size], data[2 + size:]
+
+
+def batch_entry_size(topic: bytes, key: bytes, data: bytes) -> int:
+    """Size of single message packed with ``pack_batch``"""
+    return 2 + len(topic) + 2 + len(key) + PACKET_SIZE_SIZE + len(data)
+
+
+def pack_batch(messages: Iterable[Tuple[bytes, bytes, bytes]]) -> bytes:
+    """Pack (topic, key, data) triples into single forwarded message"""
+    parts = []
+    for topic, key, data in messages:
+        parts.append(len(topic).to_bytes(2, ENDIANNESS) + topic)
+        parts.append(len(key).to_bytes(2, ENDIANNESS) + key)
+        parts.append(len(data).to_bytes(PACKET_SIZE_SIZE, ENDIANNESS) + data)
+    return b"".join(parts)
+
+
+def unpack_batch(batch: bytes) -> List[Tuple[bytes, bytes, bytes]]:
+    """Unpack message packed with ``pack_batch``"""
+    messages = []
+    pos = 0
+    while pos < len(batch):
+        entry = []
+        for size_size in (2, 2, PACKET_SIZE_SIZE):
+            size = int.from_bytes(batch[pos:pos + size_size], ENDIANNESS)
+            pos += size_size
+            entry.append(batch[pos:pos + size])
+            pos += size
+            if len(entry[-1]) != size:
+                raise ParsingError("Batch is truncated")
+        messages.append(tuple(entry))
+    return messages
+
+
 def command(cmd: AnyStr, topic: AnyStr, data: AnyStr = b""):
     """Command message, e.g. b'SUB::topic,data'"""
     cmd, topic, data = _convert_to_bytes(cmd, topic, data)  # pylint: disable=unbalanced-tuple-unpacking
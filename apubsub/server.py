@@ -1,17 +1,23 @@
 """Message service"""
 
 import asyncio
+import functools
 import logging
 import socket
 import time
 from collections import deque
 from multiprocessing import Event, Lock, Process, synchronize
-from typing import Deque, Dict, Set
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
 from uuid import uuid4
 
 from .client import Client, LOCALHOST
 from .connection_wrapper import NoData, NotMessage, receive, send
-from .protocol import CMD_PORT, CMD_PUB, CMD_SUB, CMD_UNSUB, ENDIANNESS, UTF8, err, ok, parse_command
+from .protocol import (ADLER_SIZE, CMD_FORWARD, CMD_KEYED_PUB, CMD_PEER, CMD_PEER_SUB, CMD_PEER_UNSUB, CMD_PORT,
+                       CMD_PUB, CMD_SUB, CMD_TRACE, CMD_UNSUB, ENDIANNESS, MAX_PACKET_SIZE, OK, SUB_SEPARATOR,
+                       TRACE_DUMP, TRACE_OFF, TRACE_PROFILE, TRACE_RING, UTF8, ParsingError, batch_entry_size, command,
+                       err, ok, pack_batch, parse_cmd_response, parse_command, unpack_batch, unpack_keyed)
+from .snapshot import RoutingState, SnapshotError, load, save
+from .tracing import DELIVER, PARSE, ROUTE, ProfileSink, RingBufferSink, get_sink, set_sink, span
 
 try:  # pragma: no cover
     # noinspection PyUnresolvedReferences
@@ -25,23 +31,191 @@ LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 
 
+ACK_TIMEOUT = 1.0
+"""Seconds to wait for client to acknowledge delivered message"""
+
+
 async def _send_singe(port, data):
+    with span(DELIVER, port):
+        await _deliver(port, data)
+
+
+async def _deliver(port, data):
     try:
-        _, writer = await asyncio.open_connection(LOCALHOST, port)
-    except ConnectionError:
+        reader, writer = await asyncio.open_connection(LOCALHOST, port)
+    except OSError:
         LOGGER.exception(f"Failed to send data to client {port}")
         return
-    await send(writer, data)
-    writer.close()
-    await writer.wait_closed()
+    try:
+        await send(writer, data)
+        await asyncio.wait_for(receive(reader), ACK_TIMEOUT)
+    except asyncio.TimeoutError:
+        LOGGER.warning("Client %s hasn't acknowledged message in %s seconds", port, ACK_TIMEOUT)
+    except (OSError, asyncio.IncompleteReadError, NoData, NotMessage):
+        LOGGER.exception(f"Client {port} failed to acknowledge message")
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+DELIVERY_QUEUE_SIZE = 10000
+"""Messages waiting to be delivered to single client, newer messages are dropped when it's full"""
+
+Peer = Tuple[str, int]
+
+PEER_TIMEOUT = 3.0
+"""Seconds to wait for peer service response"""
+
+LINK_QUEUE_SIZE = 10000
+"""Messages waiting to be forwarded to single peer, newer messages are dropped when it's full"""
 
+PEER_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, NoData, NotMessage)
+"""Errors of communication with unreachable or misbehaving peer"""
 
-def port_busy(port: int) -> bool:
+WILDCARD_HOSTS = ("", "0.0.0.0", "::")
+
+
+def _peer_id(peer: Peer) -> str:
+    return "{}:{}".format(*peer)
+
+
+def _parse_peer_id(peer_id: str) -> Peer:
+    host, port = peer_id.rsplit(":", 1)
+    return host, int(port)
+
+
+def _parse_sub(data: bytes) -> Tuple[int, Optional[float]]:
+    """Client port and, for conflated subscription, delivery interval in seconds"""
+    port = int.from_bytes(data[:2], ENDIANNESS)
+    if len(data) == 2:
+        return port, None
+    return port, int.from_bytes(data[2:6], ENDIANNESS) / 1000
+
+
+async def _request(peer: Peer, message: bytes) -> bytes:
+    """Send message to another service and return its response"""
+    return await asyncio.wait_for(_exchange(peer, message), PEER_TIMEOUT)
+
+
+async def _exchange(peer: Peer, message: bytes) -> bytes:
+    reader, writer = await asyncio.open_connection(*peer)
+    try:
+        await send(writer, message)
+        return await receive(reader)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+class _Delivery:
+    """Ordered delivery of messages to single client
+
+    Messages are sent one by one by background task, so publisher never waits for slow client
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.queue: asyncio.Queue = asyncio.Queue(DELIVERY_QUEUE_SIZE)
+        self.task: Optional[asyncio.Task] = None
+
+    def offer(self, data: bytes):
+        """Put message to delivery, message is dropped if client is too far behind"""
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            LOGGER.warning("Delivery queue of client %s is full, message dropped", self.port)
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            data = await self.queue.get()
+            try:
+                await _send_singe(self.port, data)
+            except asyncio.CancelledError:  # it's Exception subclass before python 3.8
+                raise
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Failed to deliver message to client %s", self.port)
+
+
+class _Conflator:
+    """Delivery of conflated subscriptions for single client
+
+    Only the latest undelivered message per (topic, key) is kept, newer message replaces
+    pending one in place. Messages of the topic are delivered not more often than
+    once per topic interval for every key
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.intervals: Dict[str, float] = {}
+        self.pending: Dict[Tuple[str, bytes], bytes] = {}
+        self.sent_at: Dict[Tuple[str, bytes], float] = {}
+        self.ready: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def offer(self, topic: str, key: bytes, data: bytes):
+        """Put message to delivery, replacing pending message with the same topic and key"""
+        self.pending[topic, key] = data
+        if self.task is None or self.task.done():
+            self.ready = asyncio.Event()
+            self.task = asyncio.ensure_future(self._run())
+        self.ready.set()
+
+    def discard(self, topic: str):
+        """Stop conflated delivery of the topic"""
+        self.intervals.pop(topic, None)
+        for msg_key in [msg_key for msg_key in self.pending if msg_key[0] == topic]:
+            del self.pending[msg_key]
+        for msg_key in [msg_key for msg_key in self.sent_at if msg_key[0] == topic]:
+            del self.sent_at[msg_key]
+        if not self.intervals and self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def _next_due(self, now: float) -> Tuple[Optional[Tuple[str, bytes]], float]:
+        delay = None
+        for msg_key in self.pending:
+            if msg_key not in self.sent_at:
+                return msg_key, 0
+            left = self.sent_at[msg_key] + self.intervals.get(msg_key[0], 0) - now
+            if left <= 0:
+                return msg_key, 0
+            delay = left if delay is None else min(delay, left)
+        return None, delay
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.pending:
+                self.ready.clear()
+                await self.ready.wait()
+            msg_key, delay = self._next_due(loop.time())
+            if msg_key is None:
+                self.ready.clear()
+                try:  # new message can be due earlier
+                    await asyncio.wait_for(self.ready.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            data = self.pending.pop(msg_key)
+            if self.intervals.get(msg_key[0]):
+                self.sent_at[msg_key] = loop.time()
+            try:
+                await _send_singe(self.port, data)
+            except asyncio.CancelledError:  # it's Exception subclass before python 3.8
+                raise
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Failed to deliver conflated message to client %s", self.port)
+
+
+def port_busy(port: int, host: str = LOCALHOST) -> bool:
     """Check if someone is listening to the port"""
     sock = socket.socket()
     sock.settimeout(0.1)
     try:
-        sock.connect((LOCALHOST, port))
+        sock.connect((host, port))
     except (ConnectionError, TimeoutError, socket.timeout):
         return False
     return True
@@ -51,41 +225,222 @@ def port_busy(port: int) -> bool:
 class Service:
     """Message service running in stand-alone process"""
 
-    _stop: Event = Event()
+    _stop: Event
     __run_lock: synchronize.SemLock = Lock()
     __topics: Dict[str, Set[int]]
     _service_p: Process
     _allowed_ports: Deque[int]
     port: int
+    snapshot_path: Optional[str]
+    snapshot_interval: Optional[float]
+    host: str
+    advertised_host: str
+    peers: Set[Peer]
+    __remote_topics: Dict[str, Set[Peer]]
+    __links: Dict[Peer, Tuple[asyncio.Queue, asyncio.Task]]
+    __conflators: Dict[int, _Conflator]
+    __deliveries: Dict[int, _Delivery]
+    __announcements: Dict[Peer, asyncio.Future]
 
-    async def _handle_pub(self, topic: str, data: bytes):
-        _ok = ok(CMD_PUB, topic)
-        try:
-            clients = self.__topics[topic]
-        except KeyError:
-            return _ok
-        sends = [_send_singe(port, data) for port in clients]
-        await asyncio.wait(sends)
-        return _ok
+    def _publish_local(self, topic: str, data: bytes, key: bytes = b""):
+        for port in self.__topics.get(topic, ()):
+            conflator = self.__conflators.get(port)
+            if conflator is not None and topic in conflator.intervals:
+                conflator.offer(topic, key, data)
+                continue
+            try:
+                delivery = self.__deliveries[port]
+            except KeyError:
+                delivery = self.__deliveries[port] = _Delivery(port)
+            delivery.offer(data)
 
-    async def _handle_sub(self, topic: str, port: int):
+    async def _handle_pub(self, topic: str, data: bytes, key: bytes = b"", cmd=CMD_PUB):
+        peers = self.__remote_topics.get(topic, ())
+        message = topic.encode(UTF8), key, data
+        if peers and batch_entry_size(*message) > self._forward_limit:
+            return err(cmd, topic, "Message is too big to be forwarded to peers")
+        for peer in peers:
+            try:
+                self._link(peer).put_nowait(message)
+            except asyncio.QueueFull:
+                LOGGER.warning("Forwarding queue of peer %s is full, message dropped", peer)
+        self._publish_local(topic, data, key)
+        return ok(cmd, topic)
+
+    async def _handle_sub(self, topic: str, port: int, interval: Optional[float] = None):
         try:
             self.__topics[topic].add(port)
         except KeyError:
             self.__topics[topic] = {port}
+        if interval is not None:
+            self.__conflators.setdefault(port, _Conflator(port)).intervals[topic] = interval
+        elif port in self.__conflators:
+            self.__conflators[port].discard(topic)
+        if len(self.__topics[topic]) == 1:
+            self._announce(CMD_PEER_SUB, topic)
         return ok(CMD_SUB, topic)
 
     async def _handle_unsub(self, topic: str, port: int):
+        if port in self.__conflators:
+            self.__conflators[port].discard(topic)
         try:
             self.__topics[topic].remove(port)
         except KeyError:
             pass
+        else:
+            if not self.__topics[topic]:
+                self._announce(CMD_PEER_UNSUB, topic)
         return ok(CMD_UNSUB, topic)
 
-    def _handle_port(self):
-        port = self._allowed_ports.popleft()
-        self.__clients[str(uuid4())] = port
-        return ok(CMD_PORT, f"{port}")
+    @property
+    def _local_topics(self) -> List[str]:
+        return [topic for topic, ports in self.__topics.items() if ports]
+
+    def _announce(self, cmd: bytes, topic: str):
+        """Notify peers about changed interest in topic
+
+        Peers are notified in background, so unresponsive peer doesn't delay subscribing.
+        Notifications of every peer are sent in order
+        """
+        message = command(cmd, topic, _peer_id(self.advertised_address))
+        for peer in self.peers:
+            task = asyncio.ensure_future(self._notify(peer, message, self.__announcements.get(peer)))
+            # loop keeps only weak reference to the task, previous tasks are referenced by next ones
+            self.__announcements[peer] = task
+            task.add_done_callback(functools.partial(self._forget_announcement, peer))
+
+    async def _notify(self, peer: Peer, message: bytes, previous: Optional[asyncio.Future]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await _request(peer, message)
+        except PEER_ERRORS as exc:
+            LOGGER.warning("Failed to notify peer %s: %r", peer, exc)
+        except asyncio.CancelledError:  # it's Exception subclass before python 3.8
+            raise
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Failed to notify peer %s", peer)
+
+    def _forget_announcement(self, peer: Peer, task: asyncio.Future):
+        if self.__announcements.get(peer) is task:
+            del self.__announcements[peer]
+
+    async def _greet_peers(self):
+        """Exchange topics with subscribers with all reachable peers"""
+        message = command(CMD_PEER, _peer_id(self.advertised_address), SUB_SEPARATOR.join(
+            topic.encode(UTF8) for topic in self._local_topics
+        ))
+        peers = list(self.peers)
+        results = await asyncio.gather(*[_request(peer, message) for peer in peers], return_exceptions=True)
+        for peer, result in zip(peers, results):
+            if isinstance(result, Exception):
+                LOGGER.info("Peer %s is not available: %r", peer, result)
+                continue
+            resolution, response = parse_cmd_response(result)
+            if resolution == OK:
+                self._set_remote_interest(peer, response.data)
+
+    def _set_remote_interest(self, peer: Peer, topics: bytes):
+        for subscribed in self.__remote_topics.values():
+            subscribed.discard(peer)
+        for topic in filter(None, topics.split(SUB_SEPARATOR)):
+            self.__remote_topics.setdefault(topic.decode(UTF8), set()).add(peer)
+
+    def _handle_peer(self, peer_id: str, topics: bytes):
+        peer = _parse_peer_id(peer_id)
+        if peer != self.advertised_address:
+            self.peers.add(peer)
+            self._set_remote_interest(peer, topics)
+        return ok(CMD_PEER, _peer_id(self.advertised_address), *self._local_topics)
+
+    def _handle_peer_sub(self, topic: str, peer_id: str):
+        peer = _parse_peer_id(peer_id)
+        if peer != self.advertised_address:
+            self.peers.add(peer)
+            self.__remote_topics.setdefault(topic, set()).add(peer)
+        return ok(CMD_PEER_SUB, topic)
+
+    def _handle_peer_unsub(self, topic: str, peer_id: str):
+        self.__remote_topics.get(topic, set()).discard(_parse_peer_id(peer_id))
+        return ok(CMD_PEER_UNSUB, topic)
+
+    def _handle_forward(self, batch: bytes):
+        """Deliver messages published on peer service to local subscribers only
+
+        Forwarded messages are never forwarded again, so messages can't loop between peers.
+        Messages are only put to subscriber delivery queues, so peer gets response without
+        waiting for slow subscribers
+        """
+        try:
+            messages = unpack_batch(batch)
+        except ParsingError:
+            LOGGER.exception("Can't unpack forwarded batch")
+            return err(CMD_FORWARD, _peer_id(self.advertised_address), "Invalid batch")
+        for topic, key, data in messages:
+            self._publish_local(topic.decode(UTF8), data, key)
+        return ok(CMD_FORWARD, _peer_id(self.advertised_address))
+
+    def _link(self, peer: Peer) -> asyncio.Queue:
+        try:
+            queue, _ = self.__links[peer]
+        except KeyError:
+            queue = asyncio.Queue(LINK_QUEUE_SIZE)
+            # loop keeps only weak reference to the task, so it's stored together with the queue
+            self.__links[peer] = queue, asyncio.ensure_future(self._run_link(peer, queue))
+        return queue
+
+    @property
+    def _forward_limit(self) -> int:
+        """Maximum size of packed batch fitting into single forward packet"""
+        return MAX_PACKET_SIZE - ADLER_SIZE - len(command(CMD_FORWARD, _peer_id(self.advertised_address)))
+
+    async def _run_link(self, peer: Peer, queue: asyncio.Queue):
+        """Forward messages to peer, joining all messages queued during previous send into one batch"""
+        sender_id = _peer_id(self.advertised_address)
+        limit = self._forward_limit
+        carried = None
+        while True:
+            batch = [carried if carried is not None else await queue.get()]
+            carried = None
+            size = batch_entry_size(*batch[0])
+            while not queue.empty():
+                message = queue.get_nowait()
+                message_size = batch_entry_size(*message)
+                if size + message_size > limit:
+                    carried = message  # starts next batch
+                    break
+                batch.append(message)
+                size += message_size
+            try:
+                await _request(peer, command(CMD_FORWARD, sender_id, pack_batch(batch)))
+            except PEER_ERRORS as exc:
+                LOGGER.warning("Failed to forward %s messages to peer %s: %r", len(batch), peer, exc)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Failed to forward %s messages to peer %s", len(batch), peer)
+
+    @staticmethod
+    def _handle_trace(mode: str):
+        if mode == TRACE_DUMP:
+            sink = get_sink()
+            return ok(CMD_TRACE, mode, "" if sink is None else sink.report())
+        if mode == TRACE_RING:
+            set_sink(RingBufferSink())
+        elif mode == TRACE_PROFILE:
+            set_sink(ProfileSink())
+        elif mode == TRACE_OFF:
+            set_sink(None)
+        else:
+            return err(CMD_TRACE, mode, "Unknown tracing mode")
+        return ok(CMD_TRACE, mode)
+
+    def _handle_port(self, session: str):
+        try:
+            port = self.__clients[session]
+        except KeyError:
+            port = self._allowed_ports.popleft()
+            session = str(uuid4())
+            self.__clients[session] = port
+        return ok(CMD_PORT, f"{port}", session)
 
     async def _handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         try:
@@ -101,57 +456,159 @@ class Service:
             await writer.wait_closed()
             return  # client hasn't done anything
 
-        command = parse_command(message)
+        with span(PARSE):
+            command = parse_command(message)
+            topic = command.topic.decode(UTF8)
         LOGGER.debug("Received command: %s", command)
-        topic = command.topic.decode(UTF8)
-        if command.command == CMD_PUB:
-            response = await self._handle_pub(topic, command.data)
-        elif command.command == CMD_SUB:
-            response = await self._handle_sub(topic, int.from_bytes(command.data, ENDIANNESS))
-        elif command.command == CMD_UNSUB:
-            response = await self._handle_unsub(topic, int.from_bytes(command.data, ENDIANNESS))
-        elif command.command == CMD_PORT:
-            response = self._handle_port()
-        else:
-            response = err(b"Unknown command", command.command)
+        with span(ROUTE, command.command):
+            if command.command == CMD_PUB:
+                response = await self._handle_pub(topic, command.data)
+            elif command.command == CMD_KEYED_PUB:
+                key, data = unpack_keyed(command.data)
+                response = await self._handle_pub(topic, data, key, CMD_KEYED_PUB)
+            elif command.command == CMD_SUB:
+                response = await self._handle_sub(topic, *_parse_sub(command.data))
+            elif command.command == CMD_UNSUB:
+                response = await self._handle_unsub(topic, int.from_bytes(command.data, ENDIANNESS))
+            elif command.command == CMD_PORT:
+                response = self._handle_port(command.data.decode(UTF8))
+            elif command.command == CMD_TRACE:
+                response = self._handle_trace(topic)
+            elif command.command == CMD_FORWARD:
+                response = self._handle_forward(command.data)
+            elif command.command == CMD_PEER:
+                response = self._handle_peer(topic, command.data)
+            elif command.command == CMD_PEER_SUB:
+                response = self._handle_peer_sub(topic, command.data.decode(UTF8))
+            elif command.command == CMD_PEER_UNSUB:
+                response = self._handle_peer_unsub(topic, command.data.decode(UTF8))
+            else:
+                response = err(b"Unknown command", command.command)
         await send(writer, response)
         writer.close()
         await writer.wait_closed()
 
-    def __init__(self, service_port=58608):
-        """Create new service instance"""
+    def __init__(self, service_port=58608, snapshot_path: str = None, snapshot_interval: float = None,
+                 host: str = LOCALHOST, peers: Iterable[Peer] = (), advertised_host: str = None):
+        """Create new service instance
+
+        If ``snapshot_path`` is given, routing state is saved there on stop
+        (and every ``snapshot_interval`` seconds, if set) and restored on start.
+
+        ``host`` is the address service listens on.
+        ``peers`` are ``(host, port)`` addresses of other services. Messages published to
+        this service are forwarded to peers having subscribers for the topic.
+        Forwarded messages are not forwarded further, so every service should peer with all others.
+        Peers reach this service on ``advertised_host``, which is required if ``host`` is wildcard address
+        """
+        if advertised_host is None:
+            if host in WILDCARD_HOSTS:
+                raise ValueError(f"Service listening on `{host}` requires `advertised_host`")
+            advertised_host = host
         self.__clients = {}
         self.__topics = {}
-        while port_busy(service_port):
+        self.__remote_topics = {}
+        self.__links = {}
+        self.__conflators = {}
+        self.__deliveries = {}
+        self.__announcements = {}
+        self.host = host
+        self.advertised_host = advertised_host
+        while port_busy(service_port, self._client_host):
             service_port -= 110
         client_start_port = service_port + 1
         self.port = service_port
+        self.peers = set(peers) - {self.advertised_address}
         self._allowed_ports = deque(range(client_start_port, client_start_port + 100))
-        self._service_p = Process(target=self._serve, args=(Service._stop,))
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._stop = Event()
+        self._service_p = Process(target=self._serve, args=(self._stop,))
 
     @property
     def address(self):
-        return LOCALHOST, self.port
+        return self.host, self.port
+
+    @property
+    def advertised_address(self) -> Peer:
+        """Address used by peers to reach the service"""
+        return self.advertised_host, self.port
+
+    @property
+    def _client_host(self) -> str:
+        return LOCALHOST if self.host in WILDCARD_HOSTS else self.host
 
-    def get_client(self) -> Client:
-        """Get new client instance for running server"""
-        client = Client(self.port)
+    def get_client(self, session: str = None) -> Client:
+        """Get new client instance for running server
+
+        Client with ``session`` of previously existing client resumes its port and subscriptions
+        """
+        client = Client(self.port, session, self._client_host)
         return client
 
+    def _routing_state(self) -> RoutingState:
+        conflated = {port: conflator.intervals for port, conflator in self.__conflators.items()}
+        return RoutingState(self.port, list(self._allowed_ports), self.__clients, self.__topics, conflated)
+
+    def _save_snapshot(self):
+        try:
+            save(self.snapshot_path, self._routing_state())
+        except OSError:
+            LOGGER.exception("Can't save routing snapshot %s", self.snapshot_path)
+            return
+        LOGGER.debug("Routing snapshot saved to %s", self.snapshot_path)
+
+    def _load_snapshot(self):
+        try:
+            state = load(self.snapshot_path)
+        except SnapshotError:
+            LOGGER.exception("Can't load routing snapshot %s", self.snapshot_path)
+            return
+        if state is None:
+            return
+        if state.service_port != self.port:
+            LOGGER.warning("Routing snapshot is made for service on port %s, ignored", state.service_port)
+            return
+        self._allowed_ports = deque(state.allowed_ports)
+        self.__clients = state.clients
+        self.__topics = state.topics
+        for port, intervals in state.conflated.items():
+            self.__conflators.setdefault(port, _Conflator(port)).intervals.update(intervals)
+        LOGGER.info("Routing state restored from %s", self.snapshot_path)
+
+    async def _snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            self._save_snapshot()
+
     def _serve(self, stop_event):
-        loop = asyncio.get_event_loop()
+        loop = asyncio.new_event_loop()  # forked process can inherit running loop of the parent
+        asyncio.set_event_loop(loop)
         server = loop.run_until_complete(asyncio.start_server(self._handle_request, *self.address))
         LOGGER.debug("Server started")
+        loop.run_until_complete(self._greet_peers())
+        if self.snapshot_path is not None and self.snapshot_interval:
+            loop.create_task(self._snapshot_periodically())
         loop.run_until_complete(_wait_for_stop(server, stop_event))
+        # delivery, forwarding and snapshot tasks are never finished by themselves
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+        if self.snapshot_path is not None:
+            self._save_snapshot()
 
     def start(self):
         """Start new service process"""
+        if self.snapshot_path is not None:
+            self._load_snapshot()
         self._stop.clear()
         self._service_p.start()
         time.sleep(.2)
         with socket.socket(socket.AF_INET) as sock:
             sock.settimeout(5)
-            sock.connect(self.address)
+            sock.connect((self._client_host, self.port))
         LOGGER.info("Service started on %s", self.address)
 
     def stop(self):
@@ -0,0 +1,134 @@
+"""Compact binary snapshot of service routing state
+
+Layout (big-endian)::
+
+    magic(4) version(1) service_port(2)
+    allowed_count(2) allowed_port(2)*
+    client_count(2) [session(16) port(2)]*
+    topic_count(2) [topic_size(2) topic subscriber_count(2) port(2)*]*
+    conflated_count(2) [port(2) topic_size(2) topic interval_ms(4)]*
+"""
+
+import os
+import struct
+from typing import Dict, List, NamedTuple, Optional, Set
+from uuid import UUID
+
+from .protocol import UTF8
+
+MAGIC = b"APSS"
+VERSION = 1
+
+_HEADER = struct.Struct(">4sBH")
+_COUNT = struct.Struct(">H")
+_CLIENT = struct.Struct(">16sH")
+_CONFLATED = struct.Struct(">HH")
+_INTERVAL = struct.Struct(">I")
+
+
+class SnapshotError(Exception):
+    """Snapshot data can't be loaded"""
+
+
+class RoutingState(NamedTuple):
+    """Service routing state"""
+
+    service_port: int
+    allowed_ports: List[int]
+    clients: Dict[str, int]
+    topics: Dict[str, Set[int]]
+    conflated: Dict[int, Dict[str, float]]
+
+
+def _ports(ports) -> bytes:
+    ports = list(ports)
+    return _COUNT.pack(len(ports)) + struct.pack(f">{len(ports)}H", *ports)
+
+
+def dumps(state: RoutingState) -> bytes:
+    """Serialize routing state"""
+    parts = [_HEADER.pack(MAGIC, VERSION, state.service_port), _ports(state.allowed_ports)]
+    parts.append(_COUNT.pack(len(state.clients)))
+    parts.extend(_CLIENT.pack(UUID(session).bytes, port) for session, port in state.clients.items())
+    topics = {topic: ports for topic, ports in state.topics.items() if ports}
+    parts.append(_COUNT.pack(len(topics)))
+    for topic, ports in topics.items():
+        b_topic = topic.encode(UTF8)
+        parts.append(_COUNT.pack(len(b_topic)) + b_topic + _ports(sorted(ports)))
+    conflated = [(port, topic, interval) for port, intervals in state.conflated.items()
+                 for topic, interval in intervals.items()]
+    parts.append(_COUNT.pack(len(conflated)))
+    for port, topic, interval in conflated:
+        b_topic = topic.encode(UTF8)
+        parts.append(_CONFLATED.pack(port, len(b_topic)) + b_topic + _INTERVAL.pack(round(interval * 1000)))
+    return b"".join(parts)
+
+
+class _Reader:
+
+    def __init__(self, data: bytes):
+        self.view = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        result = fmt.unpack_from(self.view, self.offset)
+        self.offset += fmt.size
+        return result
+
+    def count(self) -> int:
+        return self.unpack(_COUNT)[0]
+
+    def ports(self) -> tuple:
+        size = self.count()
+        return self.unpack(struct.Struct(f">{size}H"))
+
+    def raw(self, size: int) -> bytes:
+        if self.offset + size > len(self.view):
+            raise struct.error("Not enough data")
+        result = bytes(self.view[self.offset:self.offset + size])
+        self.offset += size
+        return result
+
+
+def loads(data: bytes) -> RoutingState:
+    """Deserialize routing state"""
+    reader = _Reader(data)
+    try:
+        magic, version, service_port = reader.unpack(_HEADER)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError(f"Unsupported snapshot format {magic}:{version}")
+        allowed_ports = list(reader.ports())
+        clients = {}
+        for _ in range(reader.count()):
+            session, port = reader.unpack(_CLIENT)
+            clients[str(UUID(bytes=session))] = port
+        topics = {}
+        for _ in range(reader.count()):
+            topic = reader.raw(reader.count()).decode(UTF8)
+            topics[topic] = set(reader.ports())
+        conflated = {}
+        for _ in range(reader.count()):
+            port, size = reader.unpack(_CONFLATED)
+            topic = reader.raw(size).decode(UTF8)
+            conflated.setdefault(port, {})[topic] = reader.unpack(_INTERVAL)[0] / 1000
+    except (struct.error, UnicodeDecodeError) as exc:
+        raise SnapshotError("Snapshot data is corrupted") from exc
+    return RoutingState(service_port, allowed_ports, clients, topics, conflated)
+
+
+def save(path: str, state: RoutingState):
+    """Atomically write routing state to file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(dumps(state))
+    os.replace(tmp_path, path)
+
+
+def load(path: str) -> Optional[RoutingState]:
+    """Read routing state from file, ``None`` if there is no snapshot"""
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+    return loads(data)
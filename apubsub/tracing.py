@@ -0,0 +1,166 @@
+"""Opt-in instrumentation of message processing hot path
+
+Instrumented code wraps its stages in ``span(point)``. While no sink is installed
+``span`` returns shared no-op context, so disabled tracing costs single global lookup.
+Sink is installed per-process: use ``set_sink`` in client process and
+``Client.trace`` control command for service process.
+"""
+
+import cProfile
+import io
+import pstats
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+__all__ = ["RECEIVE", "PARSE", "ROUTE", "ENCODE", "SEND", "DELIVER", "ENQUEUE", "DEQUEUE",
+           "Sink", "RingBufferSink", "CallbackSink", "ProfileSink", "SpanRecord",
+           "get_sink", "set_sink", "span"]
+
+# Instrumentation points
+
+RECEIVE = "receive"
+PARSE = "parse"
+ROUTE = "route"
+ENCODE = "encode"
+SEND = "send"
+DELIVER = "deliver"
+ENQUEUE = "enqueue"
+DEQUEUE = "dequeue"
+
+
+class Sink:
+    """Base trace sink, receiving start and end of every span"""
+
+    def open(self):
+        """Called when sink is installed"""
+
+    def close(self):
+        """Called when sink is replaced or removed"""
+
+    def span_start(self, point: str, detail: Any) -> Any:
+        """Span started, returned value is passed to ``span_end``"""
+
+    def span_end(self, token: Any):
+        """Span finished"""
+
+    def report(self) -> str:
+        """Human-readable report of collected data"""
+        return ""
+
+
+class SpanRecord(NamedTuple):
+    """Finished span"""
+
+    point: str
+    detail: Any
+    start: float
+    duration: float
+
+
+class RingBufferSink(Sink):
+    """Sink storing last ``size`` spans in memory"""
+
+    def __init__(self, size=10000):
+        self.records: Deque[SpanRecord] = deque(maxlen=size)
+
+    def span_start(self, point: str, detail: Any) -> Tuple[str, Any, float]:
+        return point, detail, time.perf_counter()
+
+    def span_end(self, token: Tuple[str, Any, float]):
+        point, detail, start = token
+        self.records.append(SpanRecord(point, detail, start, time.perf_counter() - start))
+
+    def summary(self) -> Dict[str, Tuple[int, float]]:
+        """Span count and total duration in seconds per point"""
+        result = {}
+        for record in self.records:
+            count, total = result.get(record.point, (0, 0.0))
+            result[record.point] = (count + 1, total + record.duration)
+        return result
+
+    def report(self) -> str:
+        lines: List[str] = []
+        for point, (count, total) in sorted(self.summary().items()):
+            lines.append(f"{point}: count={count} total_ms={total * 1e3:.3f} avg_us={total / count * 1e6:.1f}")
+        return "\n".join(lines)
+
+
+class CallbackSink(Sink):
+    """Sink forwarding spans to OpenTelemetry-like callbacks
+
+    ``on_start(point, detail)`` result is passed to ``on_end``, e.g. tracer span object
+    """
+
+    def __init__(self, on_start: Callable[[str, Any], Any], on_end: Callable[[Any], None]):
+        self.span_start = on_start
+        self.span_end = on_end
+
+
+class ProfileSink(Sink):
+    """Sink running ``cProfile`` profiler while installed, spans are ignored"""
+
+    def __init__(self, limit=30):
+        self.limit = limit
+        self.profile = cProfile.Profile()
+        self.enabled = False
+
+    def open(self):
+        self.profile.enable()
+        self.enabled = True
+
+    def close(self):
+        self.profile.disable()
+        self.enabled = False
+
+    def report(self) -> str:
+        self.profile.disable()
+        output = io.StringIO()
+        pstats.Stats(self.profile, stream=output).sort_stats("cumulative").print_stats(self.limit)
+        if self.enabled:
+            self.profile.enable()
+        return output.getvalue()
+
+
+class _Span:
+    __slots__ = ("sink", "point", "detail", "token")
+
+    def __init__(self, sink: Sink, point: str, detail: Any):
+        self.sink = sink
+        self.point = point
+        self.detail = detail
+        self.token = None
+
+    def __enter__(self):
+        self.token = self.sink.span_start(self.point, self.detail)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.sink.span_end(self.token)
+
+
+_NO_SPAN = nullcontext()
+_SINK: Optional[Sink] = None
+
+
+def span(point: str, detail: Any = None):
+    """Context measuring single processing stage"""
+    if _SINK is None:
+        return _NO_SPAN
+    return _Span(_SINK, point, detail)
+
+
+def get_sink() -> Optional[Sink]:
+    """Currently installed sink"""
+    return _SINK
+
+
+def set_sink(sink: Optional[Sink]):
+    """Install new sink for current process, ``None`` disables tracing"""
+    global _SINK  # pylint: disable=global-statement
+    if _SINK is not None:
+        _SINK.close()
+    if sink is not None:
+        sink.open()
+    _SINK = sink
@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+
+from apubsub import Service
+from apubsub.client import Client, ClientError, LOCALHOST
+from apubsub.protocol import MAX_PACKET_SIZE, ParsingError, pack_batch, unpack_batch
+from tests.helpers import started_client
+
+PORT_A = 56608
+PORT_B = 55608
+
+
+def test_batch_roundtrip():
+    messages = [(b"topic", b"", b"data"), (b"other", b"key", b""), (b"topic", b"", b"x" * 70000)]
+    assert unpack_batch(pack_batch(messages)) == messages
+
+
+def test_batch_truncated():
+    with pytest.raises(ParsingError):
+        unpack_batch(pack_batch([(b"topic", b"", b"data")])[:-1])
+
+
+@pytest.fixture(scope="module")
+def bridged():
+    srv_a = Service(PORT_A, peers=[(LOCALHOST, PORT_B)])
+    srv_b = Service(PORT_B, peers=[(LOCALHOST, PORT_A)])
+    srv_a.start()  # peer is not available yet, it will greet us on its start
+    srv_b.start()
+    yield srv_a, srv_b
+    srv_b.stop()
+    srv_a.stop()
+
+
+@pytest.mark.asyncio
+async def test_forward_to_peer(bridged, topic, data):
+    srv_a, srv_b = bridged
+    pub: Client = srv_a.get_client()
+    sub_a, sub_b = await asyncio.gather(started_client(srv_a), started_client(srv_b))
+    await asyncio.gather(sub_a.subscribe(topic), sub_b.subscribe(topic))
+
+    await pub.publish(topic, data)
+    assert await sub_a.get(.1) == data
+    assert await sub_b.get(.5) == data
+
+    await asyncio.sleep(.2)
+    assert sub_a.get_all() == []
+    assert sub_b.get_all() == []
+
+
+@pytest.mark.asyncio
+async def test_forward_batched(bridged, topic):
+    srv_a, srv_b = bridged
+    pub: Client = srv_b.get_client()
+    sub = await started_client(srv_a)
+    await sub.subscribe(topic)
+
+    sent = [f"MSG{i}" for i in range(50)]
+    await asyncio.gather(*[pub.publish(topic, msg) for msg in sent])
+    await asyncio.sleep(.5)
+    assert sorted(sub.get_all()) == sorted(sent)
+
+
+@pytest.mark.asyncio
+async def test_no_forward_after_unsubscribe(bridged, topic, data):
+    srv_a, srv_b = bridged
+    pub: Client = srv_a.get_client()
+    sub = await started_client(srv_b)
+    await sub.subscribe(topic)
+    await sub.unsubscribe(topic)
+
+    await pub.publish(topic, data)
+    assert await sub.get(.3) is None
+
+
+@pytest.mark.asyncio
+async def test_service_on_other_host(topic, data):
+    srv = Service(52608, host="127.0.0.2")
+    srv.start()
+    try:
+        pub: Client = srv.get_client()
+        sub = await started_client(srv)
+        await sub.subscribe(topic)
+        await pub.publish(topic, data)
+        assert await sub.get(.1) == data
+    finally:
+        srv.stop()
+
+
+def test_wildcard_host_requires_advertised():
+    with pytest.raises(ValueError):
+        Service(52608, host="0.0.0.0", peers=[(LOCALHOST, PORT_A)])
+    srv = Service(52608, host="0.0.0.0", advertised_host=LOCALHOST, peers=[(LOCALHOST, 52608), (LOCALHOST, PORT_A)])
+    assert srv.advertised_address == (LOCALHOST, 52608)
+    assert srv.peers == {(LOCALHOST, PORT_A)}
+
+
+@pytest.mark.asyncio
+async def test_unreachable_peers(topic, data):
+    srv = Service(52608, peers=[("no-such-host.invalid", 1), (LOCALHOST, 1)])
+    srv.start()
+    try:
+        pub: Client = srv.get_client()
+        sub = await started_client(srv)
+        await sub.subscribe(topic)
+        await pub.publish(topic, data)
+        assert await sub.get(.1) == data
+    finally:
+        srv.stop()
+
+
+@pytest.mark.asyncio
+async def test_forward_not_blocked_by_stuck_client(bridged, topic):
+    srv_a, srv_b = bridged
+    pub: Client = srv_a.get_client()
+    stuck = srv_b.get_client()
+    await stuck.start_consuming(queue_size=1)
+    sub = await started_client(srv_b)
+    await asyncio.gather(stuck.subscribe(topic), sub.subscribe(topic))
+    await asyncio.sleep(.1)
+
+    sent = [f"MSG{i}" for i in range(5)]
+    for msg in sent:
+        await pub.publish(topic, msg)
+    assert [await sub.get(.5) for _ in sent] == sent
+
+
+@pytest.mark.asyncio
+async def test_unresponsive_peer(topic):
+    async def _never_respond(reader: asyncio.StreamReader, _):
+        await reader.read()
+
+    peer = await asyncio.start_server(_never_respond, LOCALHOST, 51608)
+    srv = Service(51708, peers=[(LOCALHOST, 51608)])
+    srv.start()
+    try:
+        sub = await started_client(srv)
+        await asyncio.wait_for(sub.subscribe(topic), 1)
+        await asyncio.wait_for(sub.unsubscribe(topic), 1)
+    finally:
+        srv.stop()
+        peer.close()
+
+
+@pytest.mark.asyncio
+async def test_too_big_to_forward(bridged, topic):
+    srv_a, srv_b = bridged
+    pub: Client = srv_a.get_client()
+    sub = await started_client(srv_b)
+    await sub.subscribe(topic)
+    with pytest.raises(ClientError):
+        await pub.publish(topic, "A" * (MAX_PACKET_SIZE - 40))
+
+
+@pytest.mark.asyncio
+async def test_forward_big_messages(bridged, topic):
+    srv_a, srv_b = bridged
+    pub: Client = srv_a.get_client()
+    await pub.get_port()
+    sub = await started_client(srv_b)
+    await sub.subscribe(topic)
+
+    sent = [str(i) * (MAX_PACKET_SIZE // 3) for i in range(4)]
+    await asyncio.gather(*[pub.publish(topic, msg) for msg in sent])
+    received = [await sub.get(2) for _ in sent]
+    assert sorted(received) == sorted(sent)
@@ -1,5 +1,6 @@
 import asyncio
 import string
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import pytest
@@ -8,6 +9,7 @@ from apubsub import Service
 from apubsub.client import Client, ClientError
 from apubsub.connection_wrapper import receive
 from apubsub.protocol import CMD_PUB, MAX_PACKET_SIZE, MaxSizeOverflow
+from apubsub.server import ACK_TIMEOUT
 from tests.helpers import rand_str, started_client
 
 pytestmark = pytest.mark.asyncio
@@ -59,6 +61,7 @@ async def test_receive_generator_remains(pub: Client, sub: Client, topic, data):
     await sub.subscribe(topic)
     await pub.publish(topic, data)
     await pub.publish(topic, data)
+    await asyncio.sleep(.1)
 
     async for received in sub.get_iter():
         assert received == data
@@ -188,3 +191,174 @@ async def test_send_invalid_message(service, topic):
 async def test_service_on_another_port(service):
     srv2 = Service()
     assert srv2.address != service.address[0], service.address[1] - 110
+
+
+async def test_consume_async_handler(service, pub: Client, topic):
+    sub = await started_client(service)
+    await sub.subscribe(topic)
+    sent = [f"MSG{i}" for i in range(20)]
+    await asyncio.gather(*[pub.publish(topic, msg) for msg in sent])
+
+    received = []
+    max_running = running = 0
+
+    async def _handler(msg):
+        nonlocal max_running, running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(.01)
+        received.append(msg)
+        running -= 1
+
+    asyncio.get_running_loop().call_later(.3, sub.stop_getting)
+    await sub.consume(_handler, concurrency=4)
+
+    assert sorted(received) == sorted(sent)
+    assert max_running == 4
+
+
+async def test_consume_executor_ordered(service, pub: Client, topic):
+    sub = await started_client(service)
+    await sub.subscribe(topic)
+    sent = [f"{i % 2}:{i}" for i in range(20)]
+    for msg in sent:
+        await pub.publish(topic, msg)
+
+    received = []
+    with ThreadPoolExecutor(4) as pool:
+        asyncio.get_running_loop().call_later(.3, sub.stop_getting)
+        await sub.consume(received.append, concurrency=4, executor=pool, key=lambda msg: msg[0])
+
+    for msg_key in "01":
+        assert [msg for msg in received if msg[0] == msg_key] == [msg for msg in sent if msg[0] == msg_key]
+
+
+async def test_consume_invalid_concurrency(sub: Client):
+    with pytest.raises(ValueError):
+        await sub.consume(print, concurrency=0)
+
+
+async def test_consume_coroutine_handler_in_executor(sub: Client):
+    async def _handler(_):
+        pass
+
+    with ThreadPoolExecutor() as executor, pytest.raises(ValueError):
+        await sub.consume(_handler, executor=executor)
+
+
+async def test_bounded_queue(service, pub: Client, topic):
+    sub = service.get_client()
+    await sub.start_consuming(queue_size=1)
+    await sub.subscribe(topic)
+    await pub.publish(topic, "first")
+    await pub.publish(topic, "second")
+    await asyncio.sleep(.2)
+    assert sub._data_queue.qsize() == 1
+    assert await sub.get(.1) == "first"
+    assert await sub.get(1) == "second"
+
+
+async def test_bounded_queue_drops_unacknowledged(service, pub: Client, topic):
+    sub = service.get_client()
+    await sub.start_consuming(queue_size=1)
+    await sub.subscribe(topic)
+    await pub.publish(topic, "first")
+    await pub.publish(topic, "second")
+    await asyncio.sleep(ACK_TIMEOUT + .2)
+    assert sub.get_all() == ["first"]
+    assert await sub.get(.2) is None
+
+
+async def test_conflated_latest_value(service, pub: Client, topic):
+    sub = service.get_client()
+    await sub.start_consuming(queue_size=1)
+    await sub.subscribe(topic, conflate=True)
+    for i in range(20):
+        await pub.publish(topic, f"A{i}", key="A")
+        await pub.publish(topic, f"B{i}", key="B")
+
+    received = []
+    while True:
+        msg = await sub.get(.2)
+        if msg is None:
+            break
+        received.append(msg)
+    assert len(received) < 40
+    assert "A19" in received
+    assert "B19" in received
+
+
+async def test_conflated_interval(service, pub: Client, topic):
+    sub = await started_client(service)
+    await sub.subscribe(topic, conflate=True, interval=.3)
+    await pub.publish(topic, "first")
+    assert await sub.get(.1) == "first"
+    await pub.publish(topic, "second")
+    await pub.publish(topic, "third")
+    assert await sub.get(.1) is None
+    assert await sub.get(.5) == "third"
+
+
+async def test_conflated_not_affecting_others(pub: Client, sub: Client, service, topic):
+    conflated = await started_client(service)
+    await asyncio.gather(sub.subscribe(topic), conflated.subscribe(topic, conflate=True, interval=1))
+    for i in range(5):
+        await pub.publish(topic, f"MSG{i}", key="key")
+    await asyncio.sleep(.1)
+    assert sub.get_all() == [f"MSG{i}" for i in range(5)]
+    assert conflated.get_all() == ["MSG0"]
+
+
+async def test_publish_not_blocked_by_stuck_client(service, pub: Client, sub: Client, topic):
+    stuck = service.get_client()
+    await stuck.start_consuming(queue_size=1)
+    await asyncio.gather(stuck.subscribe(topic), sub.subscribe(topic))
+    for i in range(3):
+        await asyncio.wait_for(pub.publish(topic, f"MSG{i}"), ACK_TIMEOUT / 2)
+    assert [await sub.get(.2) for _ in range(3)] == ["MSG0", "MSG1", "MSG2"]
+
+
+async def test_consume_takes_message_only_with_free_slot(service, pub: Client, topic):
+    sub = service.get_client()
+    await sub.start_consuming(queue_size=5)
+    await sub.subscribe(topic)
+    for i in range(3):
+        await pub.publish(topic, f"MSG{i}")
+
+    release = asyncio.Event()
+    started = []
+
+    async def _handler(msg):
+        started.append(msg)
+        await release.wait()
+
+    consuming = asyncio.ensure_future(sub.consume(_handler))
+    await asyncio.sleep(.2)
+    assert started == ["MSG0"]
+    assert sub._data_queue.qsize() == 2
+    sub.stop_getting()
+    release.set()
+    await consuming
+
+
+@pytest.mark.parametrize("interval", [-1, 2 ** 32 / 1000])
+async def test_conflated_invalid_interval(sub: Client, topic, interval):
+    with pytest.raises(ValueError):
+        await sub.subscribe(topic, conflate=True, interval=interval)
+
+
+async def test_interval_without_conflation(sub: Client, topic):
+    with pytest.raises(ValueError):
+        await sub.subscribe(topic, interval=1)
+
+
+async def test_conflated_resubscribe(service, pub: Client, topic):
+    sub = await started_client(service)
+    await sub.subscribe(topic, conflate=True)
+    await pub.publish(topic, "first")
+    assert await sub.get(.1) == "first"
+
+    await sub.unsubscribe(topic)
+    await sub.subscribe(topic, conflate=True)
+    await pub.publish(topic, "second")
+    assert await sub.get(.1) == "second"
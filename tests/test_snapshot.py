@@ -0,0 +1,80 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+
+from apubsub import Service
+from apubsub.snapshot import RoutingState, SnapshotError, dumps, load, loads
+from tests.helpers import started_client
+
+
+@pytest.fixture
+def state():
+    return RoutingState(
+        service_port=50000,
+        allowed_ports=[50003, 50004],
+        clients={str(uuid4()): 50001, str(uuid4()): 50002},
+        topics={"topic": {50001, 50002}, "тема": {50002}, "empty": set()},
+        conflated={50001: {"topic": .25}},
+    )
+
+
+def test_snapshot_roundtrip(state):
+    restored = loads(dumps(state))
+    assert restored.service_port == state.service_port
+    assert restored.allowed_ports == state.allowed_ports
+    assert restored.clients == state.clients
+    assert restored.topics == {"topic": {50001, 50002}, "тема": {50002}}
+    assert restored.conflated == state.conflated
+
+
+def test_snapshot_invalid_magic(state):
+    with pytest.raises(SnapshotError):
+        loads(b"XXXX" + dumps(state)[4:])
+
+
+def test_snapshot_truncated(state):
+    with pytest.raises(SnapshotError):
+        loads(dumps(state)[:-3])
+
+
+def test_snapshot_missing(tmp_path):
+    assert load(str(tmp_path / "missing")) is None
+
+
+@pytest.mark.asyncio
+async def test_warm_restart(tmp_path, topic, data):
+    path = str(tmp_path / "routing.snapshot")
+    srv = Service(57608, snapshot_path=path)
+    srv.start()
+    try:
+        sub = await started_client(srv)
+        await sub.subscribe(topic)
+    finally:
+        srv.stop()
+
+    srv = Service(srv.port, snapshot_path=path)
+    srv.start()
+    try:
+        resumed = srv.get_client(sub.session)
+        assert await resumed.get_port() == sub.port
+        new_client = srv.get_client()
+        assert await new_client.get_port() != sub.port
+
+        await new_client.publish(topic, data)
+        assert await sub.get(.1) == data
+    finally:
+        srv.stop()
+
+
+@pytest.mark.asyncio
+async def test_unwritable_snapshot(tmp_path):
+    srv = Service(57808, snapshot_path=str(tmp_path / "missing" / "routing.snapshot"), snapshot_interval=.1)
+    srv.start()
+    try:
+        await asyncio.sleep(.3)
+        client = srv.get_client()
+        assert await client.get_port()
+    finally:
+        srv.stop()
+    assert srv._service_p.exitcode == 0
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from apubsub import tracing
+from apubsub.client import Client, ClientError
+from apubsub.tracing import CallbackSink, DEQUEUE, ENQUEUE, ProfileSink, RingBufferSink, set_sink, span
+
+
+@pytest.fixture
+def ring():
+    sink = RingBufferSink(10)
+    set_sink(sink)
+    yield sink
+    set_sink(None)
+
+
+def test_disabled_span():
+    assert tracing.get_sink() is None
+    assert span(tracing.SEND) is span(tracing.RECEIVE)
+
+
+def test_ring_buffer(ring):
+    for i in range(15):
+        with span(tracing.SEND, i):
+            pass
+    assert len(ring.records) == 10
+    assert ring.records[0].detail == 5
+    assert ring.summary()[tracing.SEND][0] == 10
+    assert ring.report().startswith(tracing.SEND)
+
+
+def test_callback_sink():
+    events = []
+    set_sink(CallbackSink(lambda point, detail: events.append((point, detail)) or point, events.append))
+    try:
+        with span(tracing.PARSE, "x"):
+            pass
+    finally:
+        set_sink(None)
+    assert events == [(tracing.PARSE, "x"), tracing.PARSE]
+
+
+def test_profile_sink():
+    sink = ProfileSink()
+    set_sink(sink)
+    sorted(range(1000))
+    assert "function calls" in sink.report()
+    assert sink.enabled
+    set_sink(None)
+    assert not sink.enabled
+    report = sink.report()
+    assert "function calls" in report
+    sorted(range(1000))
+    assert sink.report() == report
+
+
+@pytest.mark.asyncio
+async def test_client_spans(ring, pub: Client, sub: Client, topic, data):
+    await sub.subscribe(topic)
+    await pub.publish(topic, data)
+    assert await sub.get(.1) == data
+    points = {record.point for record in ring.records}
+    assert {ENQUEUE, DEQUEUE} <= points
+
+
+@pytest.mark.asyncio
+async def test_service_tracing(pub: Client, sub: Client, topic, data):
+    await pub.trace("ring")
+    try:
+        await sub.subscribe(topic)
+        await pub.publish(topic, data)
+        assert await sub.get(.1) == data
+        await asyncio.sleep(.05)  # delivery span ends when service receives acknowledgement
+        report = await pub.trace("dump")
+    finally:
+        await pub.trace("off")
+    for point in (tracing.RECEIVE, tracing.PARSE, tracing.ROUTE, tracing.DELIVER, tracing.SEND):
+        assert point in report
+    assert await pub.trace("dump") == ""
+
+
+@pytest.mark.asyncio
+async def test_service_unknown_tracing_mode(pub: Client):
+    with pytest.raises(ClientError):
+        await pub.trace("unknown")